@@ -0,0 +1,95 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "perplexity-shell",
+)
+CACHE_PATH = os.path.join(CACHE_DIR, "cache.db")
+
+# Seconds a cached response stays valid
+DEFAULT_TTL = 3600
+
+
+def cache_disabled() -> bool:
+    """Returns true if caching was turned off through the environment"""
+    return os.environ.get("PERPLEXITY_CACHE_DISABLED", "").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+
+
+def normalize_query(query: str) -> str:
+    """Strip surrounding whitespace and one trailing question mark from a query.
+
+    Only changes that can't alter what is being asked are made, since
+    a wrong answer served from the cache is worse than a cache miss.
+    """
+    query = query.strip()
+    return query.removesuffix("?").rstrip() or query
+
+
+def make_key(model: str, system: str, query: str) -> str:
+    """Build the exact-match cache key for a request"""
+    return hashlib.sha256(f"{model}\0{system}\0{query}".encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Exact-match response cache persisted to a sqlite file"""
+
+    def __init__(self, path: str = CACHE_PATH):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Queries may run on worker threads, see PerplexityClient.aquery
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+            )
+        return self._conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired"""
+        try:
+            with self._lock:
+                row = (
+                    self._connect()
+                    .execute(
+                        "SELECT value FROM responses WHERE key = ? AND expires_at > ?",
+                        (key, time.time()),
+                    )
+                    .fetchone()
+                )
+        except sqlite3.Error as e:
+            self.logger.warning("Cache lookup failed: %s", e)
+            return None
+
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: float = DEFAULT_TTL) -> None:
+        """Store a JSON-serializable value under key for ttl seconds"""
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    conn.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                    conn.execute(
+                        "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                        (key, json.dumps(value), now + ttl),
+                    )
+        except sqlite3.Error as e:
+            self.logger.warning("Cache write failed: %s", e)
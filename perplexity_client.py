@@ -0,0 +1,542 @@
+import email.utils
+import http.client
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from perplexity_cache import ResponseCache, make_key, normalize_query
+
+API_HOST = "api.perplexity.ai"
+API_PATH = "/chat/completions"
+MODEL = "sonar-pro"
+SYSTEM_PROMPT = (
+    "Provide clear, structured responses with an explanation and practical "
+    "examples. Please output a JSON object with the following fields: "
+    "explanation, examples."
+)
+
+# The static parts of every request, built once per process.
+# These are shared between requests, so never mutate them.
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+_RESPONSE_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "schema": {
+            "type": "object",
+            "properties": {
+                "explanation": {
+                    "type": "string",
+                    "description": "Main explanation text",
+                },
+                "examples": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "List of examples or key points",
+                },
+            },
+            "required": ["explanation", "examples"],
+        }
+    },
+}
+
+# orjson is optional but noticeably faster on large response bodies.
+# Its JSONDecodeError subclasses json's, so handlers work with either.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def _json_loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+_JSON_DECODER = json.JSONDecoder(strict=False)
+
+# Maps every control character except newline to a space, C1 included
+# since some terminals act on those as escape sequences too
+_CONTROL_CHARS = {
+    c: " " for c in [*range(0x00, 0x0A), *range(0x0B, 0x20), *range(0x7F, 0xA0)]
+}
+
+# Same as above minus tab, for decoded strings where a tab was sent
+# as a \t escape and is part of the example, e.g. in a Makefile
+_UNSAFE_CHARS = {c: v for c, v in _CONTROL_CHARS.items() if c != 0x09}
+
+# Statuses meaning the request was turned away without being processed,
+# so retrying can't bill a completion twice. Other 5xx replies may come
+# after the completion was generated, and are returned as is.
+RETRY_STATUSES = frozenset({429, 503})
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.3
+
+# Longest Retry-After worth waiting out, rather than reporting the error
+RETRY_AFTER_MAX = 30
+
+# What a reused connection raises when the server dropped it while idle
+_STALE_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+def _retry_after(response: http.client.HTTPResponse) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, if it has a usable one"""
+    value = response.getheader("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+class ConnectionPool:
+    """Keep-alive HTTPS connections to the API, reused across requests"""
+
+    def __init__(self, host: str, maxsize: int = 10, timeout: float = 30):
+        self.host = host
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle: List[http.client.HTTPSConnection] = []
+        self._lock = threading.Lock()
+
+    def _get(self) -> Tuple[http.client.HTTPSConnection, bool]:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return http.client.HTTPSConnection(self.host, timeout=self.timeout), False
+
+    def _put(self, conn: http.client.HTTPSConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _send(
+        self, path: str, body: bytes, headers: Dict[str, str]
+    ) -> Tuple[http.client.HTTPSConnection, http.client.HTTPResponse]:
+        """POST the body and return the response with its headers read.
+
+        The request is only sent again when it can't have reached the
+        server: the connection failed to open, or a reused idle one had
+        been dropped. Anything else, a read timeout in particular, may
+        already have been billed as a completion and is raised as is.
+        """
+        for attempt in range(RETRY_TOTAL + 1):
+            conn, reused = self._get()
+            if not reused:
+                try:
+                    conn.connect()
+                except OSError:
+                    conn.close()
+                    if attempt == RETRY_TOTAL:
+                        raise
+                    time.sleep(RETRY_BACKOFF * (2**attempt))
+                    continue
+
+            try:
+                conn.request("POST", path, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except _STALE_ERRORS:
+                conn.close()
+                if not reused or attempt == RETRY_TOTAL:
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+
+        raise RuntimeError("unreachable")
+
+    def post(
+        self, path: str, body: bytes, headers: Dict[str, str]
+    ) -> Tuple[int, bytes]:
+        """POST the body, retrying throttled or unavailable replies.
+
+        Waits as long as Retry-After asks, or with exponential backoff
+        when the reply doesn't say.
+        """
+        for attempt in range(RETRY_TOTAL + 1):
+            conn, response = self._send(path, body, headers)
+            try:
+                data = response.read()
+            except BaseException:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._put(conn)
+            if response.status not in RETRY_STATUSES or attempt == RETRY_TOTAL:
+                return response.status, data
+
+            delay = _retry_after(response)
+            if delay is None:
+                delay = RETRY_BACKOFF * (2**attempt)
+            elif delay > RETRY_AFTER_MAX:
+                return response.status, data
+            time.sleep(delay)
+
+        raise RuntimeError("unreachable")
+
+    @contextmanager
+    def stream(
+        self, path: str, body: bytes, headers: Dict[str, str]
+    ) -> Iterator[http.client.HTTPResponse]:
+        """POST the body and yield the response unread, to consume incrementally"""
+        conn, response = self._send(path, body, headers)
+
+        try:
+            yield response
+        except BaseException:
+            conn.close()
+            raise
+
+        # Only fully read responses leave the connection reusable
+        if response.isclosed() and not response.will_close:
+            self._put(conn)
+        else:
+            conn.close()
+
+
+# Shared by every client in the process unless one is given its own
+_POOL = ConnectionPool(API_HOST)
+
+
+def _sanitize(value: Any) -> Any:
+    """Blank out control characters other than tab in every decoded string.
+
+    Responses are printed straight to the terminal, so an escape
+    sequence in them, raw or written as a JSON escape, must never survive.
+    """
+    if isinstance(value, str):
+        return value.translate(_UNSAFE_CHARS)
+    if isinstance(value, list):
+        return [_sanitize(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _sanitize(item) for key, item in value.items()}
+    return value
+
+
+def parse_perplexity_response(text: str) -> Dict[str, Any]:
+    # Perplexity's API often responds with a json string
+    # that has nested escaping. Gnarly stuff like
+    #
+    #  {\n      \"name\": \"Processing multi-line records\", \n
+    #   \"code\": \"awk 'BEGIN {RS=\\\"\\\\n\\\\n\\\"; FS=\\\"\\\\n\\\"}
+    # {print $1}' file.txt\",\n
+    #
+    # This is supposed to reflect the eventual formatting
+    # but is a nightmare to work with. Here, we handle it
+    # by decoding non-strictly, which keeps the embedded
+    # newlines as-is. Control characters are blanked out of
+    # the decoded strings afterwards.
+    #
+    # I don't like how fragile this is because Perplexity could
+    # change the response structure (and probably should) at
+    # any moment so hopefully this will be replaced in the
+    # future with something more robust.
+    #
+    # Callers pass the message content, already pulled out
+    # of the decoded HTTP response.
+
+    # When the model honours response_format the content is
+    # plain JSON, so try the fast strict decoder first
+    try:
+        result = _json_loads(text)
+    except json.JSONDecodeError:
+        pass
+    else:
+        if isinstance(result, dict):
+            return _sanitize(result)
+
+    # Sometimes the API will respond with 'Here is the JSON
+    # object: {...', so decode from the first brace and ignore
+    # anything trailing the object
+    start = text.find("{")
+    if start == -1:
+        raise ValueError("No JSON object found")
+
+    # Blank out control characters first, like the old regex
+    # pass did, since stray ones between tokens are invalid even
+    # to the non-strict decoder. It still has to accept the raw
+    # newlines Perplexity leaves inside string values.
+    text = text.translate(_CONTROL_CHARS)
+    try:
+        result, _ = _JSON_DECODER.raw_decode(text, start)
+    except json.JSONDecodeError:
+        # Not sure this is still necessary
+        unescaped = text[start:].encode().decode("unicode_escape")
+        result, _ = _JSON_DECODER.raw_decode(unescaped)
+
+    return _sanitize(result)
+
+
+_EXPLANATION_RE = re.compile(r'"explanation"\s*:\s*"')
+_STRING_BODY_RE = re.compile(r'(?:[^"\\]|\\.)*', re.DOTALL)
+
+
+_EXPLANATION_KEY = '"explanation"'
+
+
+class PartialExplanation:
+    """Incrementally decode the explanation from a streamed response.
+
+    Used while streaming, so the explanation can be shown before the
+    rest of the object has arrived. Each piece of the response is
+    decoded as it comes in, so the work stays linear in its length.
+    """
+
+    def __init__(self) -> None:
+        # Text not yet known to hold the start of the explanation
+        self._head = ""
+        # Undecoded end of the string so far, e.g. a cut-off escape
+        self._pending: Optional[str] = None
+        self._done = False
+        self._parts: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """The explanation decoded so far"""
+        return "".join(self._parts)
+
+    def feed(self, delta: str) -> None:
+        """Consume the next piece of the response"""
+        if self._done:
+            return
+
+        if self._pending is None:
+            self._head += delta
+            match = _EXPLANATION_RE.search(self._head)
+            if not match:
+                # Only keep what could still turn out to be the key
+                start = self._head.rfind(_EXPLANATION_KEY)
+                if start == -1:
+                    start = max(len(self._head) - len(_EXPLANATION_KEY), 0)
+                self._head = self._head[start:]
+                return
+            delta = self._head[match.end() :]
+            self._head = ""
+            self._pending = ""
+
+        # Everything up to the closing quote, or all of it if the
+        # string hasn't been closed yet
+        text = self._pending + delta
+        value = _STRING_BODY_RE.match(text).group(0)
+        self._done = text[len(value) : len(value) + 1] == '"'
+
+        # A cut-off escape like \u00 can leave up to five undecodable
+        # characters at the end, and half of a surrogate pair decodes
+        # on its own, so back off until a whole prefix decodes
+        for end in range(len(value), max(len(value) - 12, -1), -1):
+            try:
+                decoded = _JSON_DECODER.decode(f'"{value[:end]}"')
+            except json.JSONDecodeError:
+                continue
+            if decoded and "\ud800" <= decoded[-1] <= "\udbff":
+                continue
+            self._parts.append(decoded.translate(_UNSAFE_CHARS))
+            self._pending = text[end:]
+            return
+
+        # Nothing decodes, so stop rather than retrying ever more text
+        self._done = True
+
+
+class PerplexityClient:
+    """Query Perplexity through a pooled connection and optional caches"""
+
+    def __init__(
+        self,
+        api_key: str,
+        *,
+        cache: Optional[ResponseCache] = None,
+        session: Optional[ConnectionPool] = None,
+    ):
+        self.api_key = api_key
+        # Built once since every request sends the same headers
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        self.cache = cache
+        self.session = session or _POOL
+        self.logger = logging.getLogger(__name__)
+
+    def _cached(self, prompt: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        if self.cache is None:
+            return None
+        cache_key = make_key(MODEL, SYSTEM_PROMPT, normalize_query(prompt))
+        cached = self.cache.get(cache_key)
+        if cached is None:
+            return None
+        self.logger.debug("Cache hit: %s", cache_key)
+        content, citations = cached
+        return content, citations
+
+    def _store(
+        self, prompt: str, content: Dict[str, Any], citations: Dict[str, Any]
+    ) -> None:
+        if self.cache is not None:
+            cache_key = make_key(MODEL, SYSTEM_PROMPT, normalize_query(prompt))
+            self.cache.set(cache_key, [content, citations])
+
+    def query(self, prompt: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Construct the request, send it to Perplexity, and return the response"""
+        logger = self.logger
+
+        cached = self._cached(prompt)
+        if cached is not None:
+            return cached
+
+        payload: Dict[str, Any] = {
+            "model": MODEL,
+            "messages": [_SYSTEM_MSG, {"role": "user", "content": prompt}],
+            "response_format": _RESPONSE_SCHEMA,
+        }
+
+        # Debug logging is off for normal runs, so skip rendering
+        # the payload and response body at all in that case
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Payload: %r", payload)
+        data = _json_dumps(payload)
+        logger.debug("Sending request: POST https://%s%s", API_HOST, API_PATH)
+        try:
+            status, body = self.session.post(API_PATH, data, self.headers)
+            if status != 200:
+                raise ValueError(f"API request failed with status {status}")
+
+            # Both decoders take the raw bytes, so the body is
+            # parsed once without an intermediate str copy
+            if debug:
+                logger.debug("Response body: %s", body.decode("utf-8", "replace"))
+            response_json = _json_loads(body)
+        except (http.client.HTTPException, OSError) as e:
+            logger.error("Request error: %s", e)
+            raise
+        except json.JSONDecodeError as e:
+            logger.error("JSON decode error: %s", e)
+            if debug:
+                logger.debug(
+                    "Problematic JSON string: %s", body.decode("utf-8", "replace")
+                )
+            raise ValueError(f"Invalid JSON response: {e}")
+
+        try:
+            message = response_json["choices"][0]["message"]
+            # Use the structured output if the API already parsed it
+            # against response_format, else decode the content once
+            content = message.get("parsed")
+            if isinstance(content, dict):
+                content = _sanitize(content)
+            else:
+                content = parse_perplexity_response(message["content"])
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            logger.error("Failed to parse perplexity response: %s", e)
+            raise ValueError(f"Failed to parse perplexity response: {e}")
+        logger.debug("Content body: %s", content)
+        citations = _sanitize(response_json.get("citations", []))
+
+        self._store(prompt, content, citations)
+        return content, citations
+
+    def query_stream(
+        self, prompt: str, on_delta: Optional[Callable[[str], None]] = None
+    ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Like query, but stream the completion as server-sent events.
+
+        on_delta is called with each piece of content as it arrives.
+        Cache hits return immediately without calling it.
+        """
+        logger = self.logger
+
+        cached = self._cached(prompt)
+        if cached is not None:
+            return cached
+
+        payload: Dict[str, Any] = {
+            "model": MODEL,
+            "messages": [_SYSTEM_MSG, {"role": "user", "content": prompt}],
+            "response_format": _RESPONSE_SCHEMA,
+            "stream": True,
+        }
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Payload: %r", payload)
+        data = _json_dumps(payload)
+        logger.debug("Streaming request: POST https://%s%s", API_HOST, API_PATH)
+
+        parts: List[str] = []
+        citations: Any = []
+        try:
+            with self.session.stream(API_PATH, data, self.headers) as response:
+                if response.status != 200:
+                    response.read()
+                    raise ValueError(
+                        f"API request failed with status {response.status}"
+                    )
+
+                for line in response:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    event = line[5:].strip()
+                    if event == b"[DONE]":
+                        continue
+
+                    chunk = _json_loads(event)
+                    # Every chunk repeats the citations gathered so far
+                    citations = chunk.get("citations", citations)
+                    for choice in chunk.get("choices", []):
+                        delta = choice.get("delta", {}).get("content")
+                        if delta:
+                            parts.append(delta)
+                            if on_delta is not None:
+                                on_delta(delta)
+        except (http.client.HTTPException, OSError) as e:
+            logger.error("Request error: %s", e)
+            raise
+        except json.JSONDecodeError as e:
+            logger.error("JSON decode error: %s", e)
+            raise ValueError(f"Invalid JSON in stream: {e}")
+
+        try:
+            content = parse_perplexity_response("".join(parts))
+        except ValueError as e:
+            logger.error("Failed to parse perplexity response: %s", e)
+            raise ValueError(f"Failed to parse perplexity response: {e}")
+        logger.debug("Content body: %s", content)
+        citations = _sanitize(citations)
+
+        self._store(prompt, content, citations)
+        return content, citations
+
+    async def aquery(self, prompt: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Run query without blocking the event loop.
+
+        Each call runs on a worker thread with its own pooled connection,
+        so gathering several queries overlaps their network latency, and
+        retry backoff sleeps never stall the loop.
+        """
+        # Imported here since asyncio is slow to load and only the
+        # daemon needs it, not a one-off query from the shell
+        import asyncio
+
+        return await asyncio.to_thread(self.query, prompt)
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+from typing import Any, Dict, Optional
+
+from perplexity_client import PerplexityClient
+from perplexity_socket import SOCKET_PATH, is_private_dir
+
+
+class PerplexityDaemon:
+    """Serve queries over a Unix socket from one long-lived process.
+
+    Keeps the interpreter, connection pool and caches warm between
+    shell invocations. Each request is a single line of JSON,
+    {"query": ..., "no_cache": ...}, answered with a single line of
+    {"content": ..., "citations": ...} or {"error": ...}.
+    """
+
+    def __init__(
+        self,
+        client: PerplexityClient,
+        uncached_client: Optional[PerplexityClient] = None,
+        path: str = SOCKET_PATH,
+    ):
+        self.client = client
+        self.uncached_client = uncached_client or client
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request = json.loads(await reader.readline())
+            client = self.uncached_client if request.get("no_cache") else self.client
+            content, citations = await client.aquery(request["query"])
+            reply: Dict[str, Any] = {"content": content, "citations": citations}
+        except Exception as e:
+            self.logger.error("Daemon request failed: %s", e)
+            reply = {"error": str(e)}
+
+        writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+    async def serve(self) -> None:
+        """Listen on the socket until cancelled"""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if not is_private_dir(directory):
+            raise RuntimeError(f"{directory} must be a directory only we can access")
+        if _is_listening(self.path):
+            raise RuntimeError(f"A daemon is already listening on {self.path}")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        # Create the socket owner-only so other users can't spend our key
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle, path=self.path)
+        finally:
+            os.umask(umask)
+
+        self.logger.info("Listening on %s", self.path)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def _is_listening(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
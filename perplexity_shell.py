@@ -1,36 +1,58 @@
-import argparse
 import logging
 import os
 import sys
-import urllib.request
-import urllib.error
-import json
-from typing import Any, Dict, Tuple
-from rich.console import Console, Group
-from rich.panel import Panel
-from rich.markdown import Markdown
-from rich.syntax import Syntax
-from rich.logging import RichHandler
-from rich.align import Align
-from rich.text import Text
-from rich.table import Table
-from rich import box
-from rich.padding import Padding
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List
 import re
+from perplexity_cache import ResponseCache, cache_disabled
+from perplexity_client import PartialExplanation, PerplexityClient
+from perplexity_socket import query_daemon
+
+# Footnote markers like [1] that Perplexity uses to reference citations.
+# Zero-padded numbers like [01] are left alone rather than guessed at.
+_CITATION_RE = re.compile(r"\[([1-9]\d*)\]")
+
+# How much of a code example to look at when guessing its language
+_LEXER_SAMPLE = 128
+
+
+@lru_cache(maxsize=64)
+def _guess_lexer(sample: str) -> str:
+    from rich.syntax import Syntax
+
+    return Syntax.guess_lexer(sample)
+
+
+class _LazyFileHandler(logging.FileHandler):
+    """File handler that creates its directory and file on the first record"""
+
+    def __init__(self, filename: str):
+        super().__init__(filename, delay=True)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
 
 
 def setup_logging(debug: bool = False) -> None:
+    # basicConfig would be a no-op anyway, so skip building handlers
+    if logging.getLogger().hasHandlers():
+        return
+
+    from rich.logging import RichHandler
+
     level = logging.DEBUG if debug else logging.INFO
 
     log_dir = os.path.join(os.path.dirname(__file__), "logs")
-    os.makedirs(log_dir, exist_ok=True)
 
     logging.basicConfig(
         level=level,
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         handlers=[
             RichHandler(rich_tracebacks=True, markup=True),
-            logging.FileHandler(os.path.join(log_dir, "perplexity.log")),
+            _LazyFileHandler(os.path.join(log_dir, "perplexity.log")),
         ],
     )
 
@@ -38,85 +60,129 @@ def setup_logging(debug: bool = False) -> None:
 class TerminalFormatter:
     """Handle terminal output formatting using Rich"""
 
+    # Rich is imported where it's used rather than at module load,
+    # since it accounts for most of the start-up time of a query
+
     def __init__(self):
+        from rich.console import Console
+
         self.console = Console(markup=True)
         self.logger = logging.getLogger(__name__)
 
     @staticmethod
     def _format_citations(citations: Dict[str, Any], content: str) -> str:
         """Adds citations url to footnote annotation"""
-
-        for i, citation in enumerate(citations, start=1):
-            citation_url = citation if citation else "#"
-            content = re.sub(
-                f"\\[{i}\\]",
-                f"[link={citation_url}][cyan][{i}][/cyan][/link]",
-                content,
-            )
-
-        return content
+        # Most code-only answers have no markers, and a substring
+        # check is far cheaper than a regex scan
+        if "[" not in content:
+            return content
+
+        # Build each link once, since markers like [1] are often
+        # repeated throughout the answer
+        links = [
+            f"[link={citation_url or '#'}][cyan][{i}][/cyan][/link]"
+            for i, citation_url in enumerate(citations, start=1)
+        ]
+
+        # One pass over the content for every marker, rather
+        # than a separate substitution per citation
+        def replace_citation(m: re.Match) -> str:
+            i = int(m.group(1))
+            if 1 <= i <= len(links):
+                return links[i - 1]
+            return m.group(0)
+
+        return _CITATION_RE.sub(replace_citation, content)
+
+    @contextmanager
+    def live_explanation(self) -> Iterator[Callable[[str], None]]:
+        """Show the explanation as it streams in.
+
+        Yields a callback taking each piece of the response text. The
+        live view is cleared on exit so format_response can take over.
+        """
+        from rich.live import Live
+        from rich.text import Text
+
+        explanation = PartialExplanation()
+        with Live(console=self.console, transient=True) as live:
+            # Live only redraws a few times a second, so rebuilding the
+            # text for every piece would be wasted work
+            interval = 1 / live.refresh_per_second
+            last_update = 0.0
+
+            def update(delta: str) -> None:
+                nonlocal last_update
+                explanation.feed(delta)
+                now = time.monotonic()
+                if now - last_update >= interval:
+                    live.update(Text(explanation.text))
+                    last_update = now
+
+            yield update
 
     def format_response(self, data: Dict[str, Any], citations: Dict[str, Any]) -> None:
         """Format the JSON response for terminal output using Rich"""
+        from rich import box
+        from rich.align import Align
+        from rich.console import Group
+        from rich.padding import Padding
+        from rich.panel import Panel
+        from rich.text import Text
+
         try:
             # This will hold the rich renderables
             rich_content = []
 
             # Add explanation (main text)
-            explanation_table = Table(
-                box=None,
-                expand=False,
-                show_header=False,
-                show_edge=False,
-                pad_edge=False,
-            )
             explanation = data.get("explanation", "")
 
             # Format the citations in the explanation text
-            if explanation and citations:
+            if explanation and citations and "[" in explanation:
                 explanation = self._format_citations(citations, explanation)
 
             # Add to renderables list
             if explanation:
-                explanation_table.add_row(explanation)
-                rich_content.append(Padding(explanation_table, (0, 0, 3, 0)))
+                rich_content.append(Padding(explanation, (0, 0, 3, 0)))
 
             # Add additional notes (examples)
             notes = data.get("examples", [])
             if notes:
-                notes_table = Table(
-                    box=None,
-                    expand=False,
-                    # show_header=False,
-                    show_edge=False,
-                    pad_edge=False,
-                    # padding=(0, 0, 1, 0),
+                notes_title = Text(
+                    "Notes", style="bold underline green", justify="center"
                 )
-                notes_table.title = "[green][b][u]Notes[/u][/b][/green]"
 
                 # This whole section needs to be cleaned up
-                notes_string = ""
+                notes_parts: List[str] = []
                 notes_renderables = []
 
                 for note in notes:
                     # Format citations in the example text
-                    if isinstance(note, str) and citations:
+                    if isinstance(note, str) and citations and "[" in note:
                         note = self._format_citations(citations, note)
 
                     # Check if note is a dict with code
                     if isinstance(note, dict) and "code" in note:
+                        # Syntax pulls in Pygments, which is only
+                        # worth loading when there is code to show
+                        from rich.syntax import Syntax
+
                         notes_renderables.append(f"{note.get('description', '')}\n")
                         code = note.get("code", "")
-                        lexer = Syntax.guess_lexer(code)
-                        syntax = Syntax(note.get("code", ""), lexer=lexer)
+                        # Trust the language if the model named one
+                        lexer = note.get("language") or _guess_lexer(
+                            code[:_LEXER_SAMPLE]
+                        )
+                        syntax = Syntax(code, lexer=lexer)
                         notes_renderables.append(syntax)
                         notes_renderables.append("\n")
                     else:
-                        notes_string += f"[yellow]•[/yellow] {note}" + "\n\n"
-                notes_table.add_row(
+                        notes_parts.append(f"[yellow]•[/yellow] {note}\n\n")
+                notes_string = "".join(notes_parts)
+                notes_body = (
                     notes_string if notes_string else Group(*notes_renderables)
                 )
-                notes_aligned = Align(notes_table, "center")
+                notes_aligned = Align(Group(notes_title, notes_body), "center")
                 rich_content.append(notes_aligned)
 
             # Group the renderables, wrap in an Align constructor,
@@ -132,175 +198,39 @@ class TerminalFormatter:
             self.console.print(panel)
 
         except Exception as e:
-            self.logger.error(f"Failed to format response: {e}")
+            self.logger.error("Failed to format response: %s", e)
             self.console.print(str(data), style="red")
 
 
-def parse_perplexity_response(raw_response: str) -> Dict[str, Any]:
-    # Perplexity's API often responds with a json string
-    # that has nested escaping. Gnarly stuff like
-    #
-    #  {\n      \"name\": \"Processing multi-line records\", \n
-    #   \"code\": \"awk 'BEGIN {RS=\\\"\\\\n\\\\n\\\"; FS=\\\"\\\\n\\\"}
-    # {print $1}' file.txt\",\n
-    #
-    # This is supposed to reflect the eventual formatting
-    # but is a nightmare to work with. Here, we handle it
-    # by replacing the control characters but preserving the
-    # newlines. A better approach would probably be to
-    # recursively unescape the content and build the JSON
-    # inside-out.
-    #
-    # I don't like how fragile this is because Perplexity could
-    # change the response structure (and probably should) at
-    # any moment so hopefully this will be replaced in the
-    # future with something more robust.
-    if '"content":' in raw_response:
-        # If key exists, assume its the raw http response and parse
-        outer_json = json.loads(raw_response)
-        text = outer_json["choices"][0]["message"]["content"]
-    else:
-        # If it doesn't, assume this is the content itself
-        text = raw_response
-
-    # Matches the JSON object, since sometimes the
-    # API will response with 'Here is the JSON object: {..."
-    match = re.search(r"({[^}]*}(?:[^}]*})*)", text, re.DOTALL)
-    if not match:
-        raise ValueError("No JSON object found")
-
-    json_str = match.group(1)
-
-    # To preserve nested escaped newlines, we sometimes
-    # temporarily replace them with a valid stand-in
-    # and then restore them at the end
-    def replace_newlines(m):
-        s = m.group(1)
-        s = re.sub(r"(?<!\\)\n", "{{NEWLINE}}", s)
-        return s
-
-    json_str = re.sub(r'("(?:\\.|[^"\\])*")', replace_newlines, json_str)
-
-    # Removes any remaining control characters
-    json_str = re.sub(r"[\x00-\x09\x0b-\x1F]", " ", json_str)
-
-    # Not sure this is still necessary
-    try:
-        result = json.loads(json_str)
-    except json.JSONDecodeError:
-        json_str = json_str.encode().decode("unicode_escape")
-        result = json.loads(json_str)
-
-    # Recursively restore the newlines we had previously replaced
-    def restore_newlines(obj):
-        if isinstance(obj, dict):
-            return {k: restore_newlines(v) for k, v in obj.items()}
-        elif isinstance(obj, list):
-            return [restore_newlines(item) for item in obj]
-        elif isinstance(obj, str):
-            return obj.replace("{{NEWLINE}}", "\n")
-        return obj
-
-    return restore_newlines(result)
-
-
-def query_perplexity(query: str, api_key: str) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-    """Construct the request, send it to Perplexity, and return the response"""
-    logger = logging.getLogger(__name__)
-    url = "https://api.perplexity.ai/chat/completions"
-
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-
-    response_schema = {
-        "type": "json_schema",
-        "json_schema": {
-            "schema": {
-                "type": "object",
-                "properties": {
-                    "explanation": {
-                        "type": "string",
-                        "description": "Main explanation text",
-                    },
-                    "examples": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                        "description": "List of examples or key points",
-                    },
-                },
-                "required": ["explanation", "examples"],
-            }
-        },
-    }
-
-    payload: Dict[str, Any] = {
-        "model": "sonar-pro",
-        "messages": [
-            {
-                "role": "system",
-                "content": "Provide clear, structured responses with an explanation and practical examples. Please output a JSON object with the following fields: explanation, examples.",
-            },
-            {"role": "user", "content": query},
-        ],
-        "response_format": response_schema,
-    }
-
-    logger.debug(payload)
-    data = json.dumps(payload).encode("utf-8")
-    request = urllib.request.Request(url, data=data, headers=headers, method="POST")
-    logger.debug(f"Sending request: {request}")
-    try:
-        with urllib.request.urlopen(request, timeout=30) as response:
-            if response.status != 200:
-                raise ValueError(f"API request failed with status {response.status}")
-
-            response_body = response.read().decode("utf-8")
-            logger.debug(f"Response body: {response_body}")
-            try:
-                content = parse_perplexity_response(response_body)
-                logger.debug(f"Content body: {content}")
-                citations = json.loads(response_body)["citations"]
-                return content, citations
-            except Exception as e:
-                logger.error(f"Failed to parse perplexity response: {e}")
-            # response_json = json.loads(response_body)
-            # logger.debug(f"Response body: {response_body}")
-            # try:
-            #     if "choices" in response_json and len(response_json["choices"]) > 0:
-            #         # Escapes the newlines often included in Perplexity's response
-            #         logger.debug(f"Choices: {response_json['choices']}")
-            #         content = json.dumps(
-            #             response_json["choices"][0]["message"]["content"]
-            #         )
-            #         logger.info(f"Choices to str: {content}")
-            #
-            #         return json.loads(json.loads(content))
-            #     return {"explanation": "No result from Perplexity."}
-            # except json.decoder.JSONDecodeError:
-            #     logger.error(f"Failed to decode choices: {content}")
-
-    except (urllib.error.HTTPError, urllib.error.URLError) as e:
-        logger.error(f"Request error: {e}")
-        raise
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e}")
-        logger.debug(f"Problematic JSON string: {response_body}")
-        raise ValueError(f"Invalid JSON response: {e}")
-
-
 def main() -> None:
+    # Only needed here, so keep it off the module import path
+    import argparse
+
     parser = argparse.ArgumentParser(description="Search using Perplexity AI")
-    parser.add_argument("--query", required=True, help="Search query")
+    parser.add_argument("--query", help="Search query")
     parser.add_argument("--api_key", help="Perplexity API key")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Bypass the local response cache"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Show the explanation while the response is streamed in",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Serve queries from a background process over a Unix socket",
+    )
     args = parser.parse_args()
+    if not args.query and not args.daemon:
+        parser.error("--query is required")
 
     setup_logging(args.debug)
     logger = logging.getLogger(__name__)
 
-    logger.debug("Arguments: " + str(args))
+    logger.debug("Arguments: %s", args)
 
     api_key = args.api_key or os.environ.get("PERPLEXITY_API_KEY")
     if not api_key:
@@ -308,12 +238,40 @@ def main() -> None:
             "No API key provided. Set PERPLEXITY_API_KEY environment variable."
         )
 
+    use_cache = not (args.no_cache or cache_disabled())
+    client = PerplexityClient(api_key, cache=ResponseCache() if use_cache else None)
+
+    if args.daemon:
+        # Only the daemon needs these, and asyncio is slow to import
+        import asyncio
+
+        from perplexity_daemon import PerplexityDaemon
+
+        daemon = PerplexityDaemon(client, uncached_client=PerplexityClient(api_key))
+        try:
+            asyncio.run(daemon.serve())
+        except KeyboardInterrupt:
+            pass
+        return
+
     try:
         formatter = TerminalFormatter()
-        content, citations = query_perplexity(args.query, api_key)
+        if args.stream:
+            with formatter.live_explanation() as on_delta:
+                content, citations = client.query_stream(args.query, on_delta)
+        else:
+            # A running daemon already has a warm connection and caches,
+            # otherwise query from this process. It bills the key it was
+            # started with, so an explicit --api_key bypasses it.
+            result = None
+            if not args.api_key:
+                result = query_daemon(args.query, no_cache=not use_cache)
+            if result is None:
+                result = client.query(args.query)
+            content, citations = result
         formatter.format_response(content, citations)
     except Exception as e:
-        logger.error(f"Error: {e}")
+        logger.error("Error: %s", e)
         sys.exit(1)
 
 
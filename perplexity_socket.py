@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+import socket
+import stat
+import tempfile
+from typing import Any, Dict, Optional, Tuple
+
+# Kept in a directory only we can enter, so another user can neither
+# connect to our daemon nor plant a socket of their own for us to use
+SOCKET_DIR = (
+    os.path.join(os.environ["XDG_RUNTIME_DIR"], "perplexity-shell")
+    if os.environ.get("XDG_RUNTIME_DIR")
+    else os.path.join(tempfile.gettempdir(), f"perplexity-shell-{os.getuid()}")
+)
+SOCKET_PATH = os.path.join(SOCKET_DIR, "daemon.sock")
+
+# Long enough to cover the API timeout plus its retries
+CLIENT_TIMEOUT = 150
+
+
+def is_private_dir(path: str) -> bool:
+    """Returns true if path is a directory, not a symlink, that only we can access"""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(st.st_mode)
+        and st.st_uid == os.getuid()
+        and not st.st_mode & 0o077
+    )
+
+
+def _is_own_socket(path: str) -> bool:
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid()
+
+
+def query_daemon(
+    query: str, no_cache: bool = False, path: str = SOCKET_PATH
+) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Send a query to a running daemon, or return None if none is listening"""
+    if not os.path.lexists(path):
+        return None
+    if not (is_private_dir(os.path.dirname(path)) and _is_own_socket(path)):
+        logging.getLogger(__name__).warning(
+            "Ignoring %s, it isn't a socket in a directory only we can access", path
+        )
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            # Stale socket file left behind by a daemon that died
+            return None
+
+        sock.settimeout(CLIENT_TIMEOUT)
+        request = {"query": query, "no_cache": no_cache}
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as reply_file:
+            reply = json.loads(reply_file.readline())
+
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply["content"], reply["citations"]
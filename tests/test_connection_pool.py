@@ -0,0 +1,134 @@
+import http.client
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+from unittest import mock
+
+import perplexity_client
+from perplexity_client import RETRY_TOTAL, ConnectionPool
+
+# (status, Retry-After, seconds to wait before replying, drop connection after)
+Reply = Tuple[int, Optional[str], float, bool]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        server.hits += 1
+        status, retry_after, delay, drop = (
+            server.replies.pop(0) if server.replies else (200, None, 0.0, False)
+        )
+        # Not time.sleep, which the tests patch out for the client
+        threading.Event().wait(delay)
+
+        body = f"reply {server.hits}".encode()
+        try:
+            self.send_response(status)
+            if retry_after is not None:
+                self.send_header("Retry-After", retry_after)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # The client gave up waiting
+            pass
+        # Close without saying so, like a server timing out an idle connection
+        self.close_connection = drop
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Exercise the pool against a local plain HTTP server"""
+
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.hits = 0
+        self.server.replies: List[Reply] = []
+        threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+        ).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        # The pool only speaks HTTPS, but TLS doesn't matter here
+        patcher = mock.patch.object(
+            http.client, "HTTPSConnection", http.client.HTTPConnection
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sleep = mock.patch.object(perplexity_client.time, "sleep")
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+        self.pool = ConnectionPool(f"127.0.0.1:{self.server.server_port}", timeout=1)
+        self.addCleanup(self._close_idle)
+
+    def _close_idle(self) -> None:
+        for conn in self.pool._idle:
+            conn.close()
+
+    def test_retries_throttled_and_unavailable(self) -> None:
+        self.server.replies = [(429, None, 0, False), (503, None, 0, False)]
+        self.assertEqual(self.pool.post("/", b"{}", {}), (200, b"reply 3"))
+        self.assertEqual(self.server.hits, 3)
+
+    def test_honours_retry_after(self) -> None:
+        self.server.replies = [(503, "2", 0, False)]
+        self.assertEqual(self.pool.post("/", b"{}", {})[0], 200)
+        self.sleep.assert_called_once_with(2.0)
+
+    def test_long_retry_after_is_not_waited_out(self) -> None:
+        self.server.replies = [(429, "3600", 0, False)]
+        self.assertEqual(self.pool.post("/", b"{}", {})[0], 429)
+        self.assertEqual(self.server.hits, 1)
+        self.sleep.assert_not_called()
+
+    def test_does_not_retry_other_server_errors(self) -> None:
+        for status in (500, 502, 504):
+            self.server.hits = 0
+            self.server.replies = [(status, None, 0, False)]
+            self.assertEqual(self.pool.post("/", b"{}", {})[0], status)
+            self.assertEqual(self.server.hits, 1)
+
+    def test_read_timeout_is_not_resent(self) -> None:
+        self.pool.timeout = 0.2
+        self.server.replies = [(200, None, 0.5, False)]
+        with self.assertRaises(TimeoutError):
+            self.pool.post("/", b"{}", {})
+        self.assertEqual(self.server.hits, 1)
+
+    def test_resends_on_dropped_idle_connection(self) -> None:
+        self.server.replies = [(200, None, 0, True)]
+        self.assertEqual(self.pool.post("/", b"{}", {}), (200, b"reply 1"))
+        self.assertEqual(len(self.pool._idle), 1)
+
+        # The pooled connection was closed by the server in the meantime
+        self.assertEqual(self.pool.post("/", b"{}", {}), (200, b"reply 2"))
+        self.assertEqual(self.server.hits, 2)
+
+    def test_retries_failed_connect(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(ConnectionRefusedError):
+            self.pool.post("/", b"{}", {})
+        self.assertEqual(self.sleep.call_count, RETRY_TOTAL)
+
+    def test_stream_returns_read_connection_to_pool(self) -> None:
+        with self.pool.stream("/", b"{}", {}) as response:
+            self.assertEqual(response.read(), b"reply 1")
+        self.assertEqual(len(self.pool._idle), 1)
+
+    def test_stream_closes_unread_connection(self) -> None:
+        with self.pool.stream("/", b"{}", {}) as response:
+            self.assertEqual(response.status, 200)
+        self.assertEqual(self.pool._idle, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
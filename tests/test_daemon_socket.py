@@ -0,0 +1,94 @@
+import asyncio
+import json
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from perplexity_client import PerplexityClient
+from perplexity_daemon import PerplexityDaemon
+from perplexity_socket import query_daemon
+
+
+class QueryDaemonTest(unittest.TestCase):
+    """Check which sockets query_daemon is willing to talk to"""
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = os.path.join(tmp.name, "run")
+        os.mkdir(self.dir, 0o700)
+        self.path = os.path.join(self.dir, "daemon.sock")
+
+    def _listen(self) -> socket.socket:
+        """Bind a socket that answers one request with a canned reply"""
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(self.path)
+        server.listen()
+        server.settimeout(0.5)
+
+        def reply() -> None:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            with conn, conn.makefile("rb") as request_file:
+                request = json.loads(request_file.readline())
+                reply = {"content": {"explanation": request["query"]}, "citations": []}
+                conn.sendall(json.dumps(reply).encode("utf-8") + b"\n")
+
+        thread = threading.Thread(target=reply, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        return server
+
+    def test_queries_socket_in_private_directory(self) -> None:
+        self._listen()
+        self.assertEqual(
+            query_daemon("hi", path=self.path), ({"explanation": "hi"}, [])
+        )
+
+    def test_missing_socket(self) -> None:
+        self.assertIsNone(query_daemon("hi", path=self.path))
+
+    def test_rejects_socket_in_shared_directory(self) -> None:
+        server = self._listen()
+        os.chmod(self.dir, 0o755)
+        with self.assertLogs("perplexity_socket", "WARNING"):
+            self.assertIsNone(query_daemon("hi", path=self.path))
+
+        # The check happens before connecting, so nothing was sent
+        server.setblocking(False)
+        with self.assertRaises(BlockingIOError):
+            server.accept()
+
+    def test_rejects_symlinked_directory(self) -> None:
+        self._listen()
+        link = self.dir + "-link"
+        os.symlink(self.dir, link)
+        with self.assertLogs("perplexity_socket", "WARNING"):
+            path = os.path.join(link, "daemon.sock")
+            self.assertIsNone(query_daemon("hi", path=path))
+
+    def test_rejects_file_that_is_not_a_socket(self) -> None:
+        open(self.path, "w").close()
+        with self.assertLogs("perplexity_socket", "WARNING"):
+            self.assertIsNone(query_daemon("hi", path=self.path))
+
+
+class PerplexityDaemonTest(unittest.TestCase):
+    def test_refuses_shared_directory(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chmod(tmp, 0o755)
+            daemon = PerplexityDaemon(
+                PerplexityClient("key"), path=os.path.join(tmp, "daemon.sock")
+            )
+            with self.assertRaises(RuntimeError):
+                asyncio.run(daemon.serve())
+            self.assertEqual(os.listdir(tmp), [])
+
+
+if __name__ == "__main__":
+    unittest.main()